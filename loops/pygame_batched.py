@@ -0,0 +1,385 @@
+"""
+Gamepad input loop forwarding a pygame joystick to the emulated switch controller.
+
+Events are drained in batches, sticks are coalesced to their latest value and each batch results in a single
+input report. Importing this module imports pygame, so only do so when a gamepad is actually used.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+
+import pygame
+
+from joycontrol.controller_state import ControllerState
+from joycontrol.transport import NotConnectedError
+from mappings import buttons, stick_sides, stick_directions
+
+logger = logging.getLogger(__name__)
+
+# log every gamepad input, very noisy
+DEBUG_INPUT = False
+
+# timeout of pygame.event.wait, lets the pump thread notice when it should stop
+EVENT_WAIT_TIMEOUT_MS = 50
+
+# maximum number of button edges buffered between the pump thread and run(), axes are always coalesced
+MAX_BUTTON_EDGES = 256
+
+# upper bound for input reports per second sent on behalf of the gamepad
+SEND_RATE = 120
+
+# stick changes smaller than this (on the 0..4095 scale) are treated as jitter
+STICK_DEADBAND = 8
+
+# buttons triggering a shock when run() is given a PavlokShocker
+SHOCK_BUTTONS = frozenset(("zl", "zr"))
+
+# pygame button index -> switch button name
+BUTTON_MAP = tuple(buttons[i] for i in range(len(buttons)))
+
+# pygame axis index -> (stick side, stick direction, invert value), vertical axes are inverted by pygame
+AXIS_MAP = tuple((stick_sides[i], stick_directions[i], stick_directions[i] == "v") for i in range(len(stick_sides)))
+
+# gamepad inputs covered by the maps above, everything else is ignored
+AXES_OF_INTEREST = frozenset(range(len(AXIS_MAP)))
+BUTTONS_OF_INTEREST = frozenset(range(len(BUTTON_MAP)))
+
+
+def init_joysticks():
+    """
+    Initializes pygame and all connected gamepads.
+    Keep the returned joysticks referenced while reading events from them.
+    """
+    pygame.init()
+
+    joysticks = []
+    for i in range(pygame.joystick.get_count()):
+        joysticks.append(pygame.joystick.Joystick(i))
+        joysticks[-1].init()
+        logger.info('Initialized gamepad %s', joysticks[-1].get_name())
+    return joysticks
+
+
+def _stick_setters(controller_state: ControllerState):
+    """
+    :returns: tuple indexed by pygame axis of (bound StickState setter, invert value),
+              the setter is None if the emulated controller lacks that stick
+    """
+    setters = []
+    for side, direction, invert in AXIS_MAP:
+        stick = controller_state.l_stick_state if side == "l" else controller_state.r_stick_state
+        if stick is None:
+            setters.append((None, invert))
+        else:
+            setters.append((stick.set_h if direction == "h" else stick.set_v, invert))
+    return tuple(setters)
+
+
+def _button_names(controller_state: ControllerState):
+    """
+    :returns: tuple indexed by pygame button of the switch button name,
+              None if the emulated controller lacks that button
+    """
+    available = controller_state.button_state.get_available_buttons()
+    return tuple(name if name in available else None for name in BUTTON_MAP)
+
+
+def _log_shock_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error('Shock failed: %s', future.exception())
+
+
+def _log_connection(future):
+    if future.cancelled():
+        return
+    if future.exception() is not None:
+        logger.error('Could not connect to the Pavlok: %s', future.exception())
+    else:
+        logger.info('Pavlok connected.')
+
+
+class PavlokShocker:
+    """
+    Connects to a Pavlok and shocks it from a single worker thread, the bluetooth calls block.
+    Shocks queue behind the connection and each other, so none are lost and they never overlap.
+    """
+    def __init__(self, connect, shock_value):
+        """
+        :param connect: callable creating the connected Pavlok
+        :param shock_value: intensity of each shock
+        """
+        self._shock_value = shock_value
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._connecting = self._executor.submit(connect)
+        self._connecting.add_done_callback(_log_connection)
+        # completes once the Pavlok is connected, raises if connecting failed
+        self.connected = asyncio.wrap_future(self._connecting)
+
+    def _shock(self):
+        self._connecting.result().shock(self._shock_value)
+
+    def shock(self):
+        """
+        Queues a shock without waiting for it.
+        """
+        self._executor.submit(self._shock).add_done_callback(_log_shock_failure)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def _compress_edges(edges):
+    """
+    Drops presses that are directly followed by the release of the same button.
+    :param edges: list of (event type, button index) tuples
+    """
+    JBD = pygame.JOYBUTTONDOWN
+    JBU = pygame.JOYBUTTONUP
+
+    compressed = []
+    for event_type, button in edges:
+        if event_type == JBU and compressed and compressed[-1] == (JBD, button):
+            compressed.pop()
+        else:
+            compressed.append((event_type, button))
+    return compressed
+
+
+def _collapse_edges(edges):
+    """
+    Reduces edges to the last one of each button, keeping their relative order.
+    The final pressed state of every button is unchanged, only intermediate presses are lost.
+    :param edges: list of (event type, button index) tuples
+    """
+    last = {}
+    for position, (event_type, button) in enumerate(edges):
+        last[button] = position
+    return [edges[position] for position in sorted(last.values())]
+
+
+class _InputBuffer:
+    """
+    Collects the input handed over by the pump thread until the consumer takes it.
+    Axis motion is coalesced to the latest value per axis. Button edges are kept in order, only if the consumer
+    falls behind by more than max_button_edges they are compressed and finally the oldest ones collapsed to the
+    last edge per button. So at most max_button_edges plus one edge per button are buffered and no button is left
+    in a state it was not in.
+    Must only be used from the thread running the asyncio loop.
+    """
+    def __init__(self, max_button_edges=MAX_BUTTON_EDGES):
+        self.ready = asyncio.Event()
+        self._max_button_edges = max_button_edges
+        self._axes = {}
+        self._edges = []
+
+    def put_batch(self, axes, edges):
+        """
+        :param axes: dict of the latest value per axis
+        :param edges: list of (event type, button index) tuples in the order they occurred
+        """
+        self._axes.update(axes)
+        buffered = self._edges
+        buffered.extend(edges)
+        if len(buffered) > self._max_button_edges:
+            buffered[:] = _compress_edges(buffered)
+            if len(buffered) > self._max_button_edges:
+                logger.warning('Input buffer full, collapsing oldest button events.')
+                split = len(buffered) - self._max_button_edges
+                buffered[:split] = _collapse_edges(buffered[:split])
+        self.ready.set()
+
+    def take(self):
+        """
+        :returns: dict of the latest value per axis and list of button edges since the last call
+        """
+        axes, edges = self._axes, self._edges
+        self._axes, self._edges = {}, []
+        self.ready.clear()
+        return axes, edges
+
+
+def _pump_events(loop, buffer, stop):
+    """
+    Blocks on SDL events in a dedicated thread and hands joystick input over to the asyncio loop.
+    Everything SDL has queued is drained and coalesced here, so the loop is woken once per batch.
+    Only plain axis values and button indices cross the thread boundary.
+    """
+    # bind hot lookups to locals once
+    event_wait = pygame.event.wait
+    event_get = pygame.event.get
+    is_stopped = stop.is_set
+    call_soon_threadsafe = loop.call_soon_threadsafe
+    put_batch = buffer.put_batch
+    NOEVENT = pygame.NOEVENT
+    JAM = pygame.JOYAXISMOTION
+    input_events = frozenset((JAM, pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP))
+    mapped_axes = AXES_OF_INTEREST
+    mapped_buttons = BUTTONS_OF_INTEREST
+
+    while not is_stopped():
+        event = event_wait(EVENT_WAIT_TIMEOUT_MS)
+        if event.type == NOEVENT:
+            continue
+
+        # take everything else SDL has buffered in the same go
+        events = [event]
+        events.extend(event_get())
+
+        axes = {}
+        edges = []
+        for event in events:
+            event_type = event.type
+            # skip hats, device and window events as well as unmapped axes and buttons
+            if event_type not in input_events:
+                continue
+            if event_type == JAM:
+                if event.axis in mapped_axes:
+                    # only the latest value per axis matters
+                    axes[event.axis] = event.value
+            elif event.button in mapped_buttons:
+                edges.append((event_type, event.button))
+
+        if axes or edges:
+            call_soon_threadsafe(put_batch, axes, edges)
+
+
+async def run(controller_state: ControllerState, shocker: PavlokShocker = None):
+    """
+    Forwards the gamepad to the controller until the connection is lost.
+    :param shocker: optional PavlokShocker, shocks whenever one of SHOCK_BUTTONS is pressed.
+                    Stops with the error if the Pavlok fails to connect.
+    """
+    joysticks = init_joysticks()
+
+    loop = asyncio.get_event_loop()
+    buffer = _InputBuffer()
+    stop = threading.Event()
+    threading.Thread(target=_pump_events, args=(loop, buffer, stop), daemon=True).start()
+
+    # the consumer only mutates the controller state (sticks and buttons) and flags it dirty,
+    # the sender reports all changes of a batch at once
+    # only the sender calls send(), the consumer requests flushes via futures in flush_waiters
+    dirty = asyncio.Event()
+    flush_waiters = []
+    consumer = asyncio.ensure_future(_consume_events(controller_state, buffer, dirty, flush_waiters, shocker))
+    sender = asyncio.ensure_future(_send_changes(controller_state, dirty, flush_waiters))
+
+    pending = {consumer, sender}
+    if shocker is not None:
+        pending.add(shocker.connected)
+
+    try:
+        # the sender returns when the connection is lost
+        while consumer in pending and sender in pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                # re-raise errors of the finished task, including a failed Pavlok connection
+                task.result()
+    finally:
+        stop.set()
+        consumer.cancel()
+        sender.cancel()
+
+
+async def _send_changes(controller_state, dirty, flush_waiters):
+    """
+    Sends the controller state whenever it was changed, but at most SEND_RATE times per second.
+    Futures in flush_waiters are resolved once a send started after they were added has completed.
+    """
+    while True:
+        await dirty.wait()
+        dirty.clear()
+        # requests added while this send is running are served by the next one
+        waiters = flush_waiters[:]
+        del flush_waiters[:]
+        try:
+            await controller_state.send()
+        except NotConnectedError:
+            logger.info('Connection was lost.')
+            return
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        await asyncio.sleep(1 / SEND_RATE)
+
+
+async def _consume_events(controller_state: ControllerState, buffer, dirty, flush_waiters, shocker):
+    button_names = _button_names(controller_state)
+    stick_setters = _stick_setters(controller_state)
+
+    last_axis = [None] * len(AXIS_MAP)
+    pressed = set()
+
+    # bind hot lookups to locals once
+    JBD = pygame.JOYBUTTONDOWN
+    create_future = asyncio.get_event_loop().create_future
+    set_button = controller_state.button_state.set_button
+    ready = buffer.ready
+    take = buffer.take
+    set_dirty = dirty.set
+
+    while True:
+        # wait for the pump thread, then take everything it has collected in the meantime
+        await ready.wait()
+        pending_axes, edges = take()
+
+        changed = False
+        pressed_in_batch = set()
+        for event_type, index in edges:
+            button = button_names[index]
+            if button is None:
+                continue
+
+            if DEBUG_INPUT:
+                logger.debug('button %s %s', button, 'down' if event_type == JBD else 'up')
+
+            if event_type == JBD:
+                if button in pressed:
+                    continue
+                pressed.add(button)
+                pressed_in_batch.add(button)
+                changed = True
+                set_button(button, pushed=True)
+                if shocker is not None and button in SHOCK_BUTTONS:
+                    # let the sender report the press first, the shock must not delay it
+                    set_dirty()
+                    shocker.shock()
+
+            else:
+                if button not in pressed:
+                    continue
+                pressed.discard(button)
+                if button in pressed_in_batch:
+                    # have the sender report the press before releasing, otherwise a quick tap never reaches
+                    # the switch
+                    flushed = create_future()
+                    flush_waiters.append(flushed)
+                    set_dirty()
+                    await flushed
+                    pressed_in_batch.clear()
+                changed = True
+                set_button(button, pushed=False)
+
+        for axis, value in pending_axes.items():
+            setter, invert = stick_setters[axis]
+            if DEBUG_INPUT:
+                logger.debug('axis %s %s', axis, value)
+            if setter is None:
+                continue
+            if invert:
+                value = -value
+            # map pygame's [-1, 1] onto the stick range [0, 4094]
+            value = int((value + 1) * 2047)
+
+            # skip stick jitter that would only resend the same position
+            last = last_axis[axis]
+            if last is not None and abs(value - last) < STICK_DEADBAND:
+                continue
+            last_axis[axis] = value
+            changed = True
+            setter(value)
+
+        if changed:
+            set_dirty()
@@ -2,6 +2,7 @@
 
 import argparse
 import asyncio
+import functools
 import logging
 import os
 
@@ -11,17 +12,11 @@ import joycontrol.debug as debug
 from joycontrol import logging_default as log, utils
 from joycontrol.command_line_interface import ControllerCLI
 from joycontrol.controller import Controller
-from joycontrol.controller_state import ControllerState, button_push, button_press, button_release
+from joycontrol.controller_state import ControllerState, button_push
 from joycontrol.memory import FlashMemory
 from joycontrol.protocol import controller_protocol_factory
 from joycontrol.server import create_hid_server
 from joycontrol.nfc_tag import NFCTag
-from joycontrol.transport import NotConnectedError
-
-import pygame
-from mappings import buttons, stick_sides, stick_directions
-
-from PyPav2.PyPav2 import Pavlok
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +30,8 @@ Usage:
                                        [--reconnect_bt_addr | -r <console_bluetooth_address>]
                                        [--log | -l <communication_log_file>]
                                        [--nfc <nfc_data_file>]
+                                       [--mode {cli,gamepad,pavlok}]
+                                       [--pavlok_mac <pavlok_bluetooth_address>] [--shock_value <value>]
     run_controller_cli.py -h | --help
 
 Arguments:
@@ -59,61 +56,43 @@ Options:
 
     --nfc <nfc_data_file>                   Sets the nfc data of the controller to a given nfc dump upon initial
                                             connection.
+
+    --mode {cli,gamepad,pavlok}             "pavlok" (default) forwards a gamepad connected via pygame and shocks
+                                            using the Pavlok at --pavlok_mac whenever ZL or ZR is pressed.
+                                            "gamepad" forwards the gamepad without shocks. "cli" opens the command
+                                            line interface, use "start_gamepad" there to forward a gamepad.
+
+    --pavlok_mac <pavlok_bluetooth_address> Bluetooth mac address of the Pavlok, only valid in "pavlok" mode.
+
+    --shock_value <value>                   Shock intensity used in "pavlok" mode, default 4.
 """
 
-def rescale(val):
-    return (int)((val+1) * 2047)
-
-async def shock(pavlok: Pavlok, shock_value):
-    pavlok.shock(shock_value)
-
-async def run(cli: ControllerCLI, pavlok: Pavlok, shock_value):
-
-    while True:
-        #await asyncio.sleep(0.01)
-
-        for event in pygame.event.get():
-
-            if event.type == pygame.JOYAXISMOTION:
-                #print("axis begin")
-                side = stick_sides[event.axis]
-                direction = stick_directions[event.axis]
-                if direction == "v":
-                    event.value *= -1
-                await cli.cmd_stick(side, direction, rescale(event.value))
-                #await asyncio.sleep(0.03)
-                #print("axis end")
-
-                try:
-            #print("send begin")
-            #await cli.controller_state.send()
-            #print("send end")
-                    #await asyncio.wait_for(cli.controller_state.send(), timeout=0.5)
-                    await cli.controller_state.send()
-                #except asyncio.TimeoutError:
-                    #logger.info("Controller send took too long.")
-                    #continue
-                except NotConnectedError:
-                    logger.info('Connection was lost.')
-                    return
-
-
-            if event.type == pygame.JOYBUTTONDOWN:
-                #print("down begin")
-                button = buttons[event.button]
-                await button_press(cli.controller_state, button)
-                if button == "zl" or button == "zr":
-                    await shock(pavlok, shock_value)
-                #print("down end")
-
-            if event.type == pygame.JOYBUTTONUP:
-                #print("up begin")
-                button = buttons[event.button]
-                await button_release(cli.controller_state, button)
-                #print("up end")
-
-        
-async def _main(args):
+async def _start_gamepad(controller_state: ControllerState):
+    """
+    start_gamepad - Starts using gamepad as a proxy for switch controller
+    """
+    # only exists to import pygame once a gamepad is actually used
+    from loops.pygame_batched import run
+    await run(controller_state)
+
+
+def _register_commands_with_controller_state(controller_state, cli):
+    """
+    Commands registered here can use the given controller state.
+    The doc string of commands will be printed by the CLI when calling "help"
+    :param cli:
+    :param controller_state:
+    """
+    # "help" prints the doc string, which a bare partial does not carry
+    start_gamepad = functools.update_wrapper(functools.partial(_start_gamepad, controller_state), _start_gamepad)
+    cli.add_command('start_gamepad', start_gamepad)
+
+
+async def _setup_transport(args, capture_file):
+    """
+    Creates the emulated controller and waits for the Switch to connect.
+    :returns: transport and command line interface of the connected controller
+    """
     # Get controller name to emulate from arguments
     controller = Controller.from_arg(args.controller)
 
@@ -125,46 +104,70 @@ async def _main(args):
         # Create memory containing default controller stick calibration
         spi_flash = FlashMemory()
 
+    # prepare the the emulated controller
+    factory = controller_protocol_factory(controller, spi_flash=spi_flash, reconnect = args.reconnect_bt_addr)
+    ctl_psm, itr_psm = 17, 19
+    transport, protocol = await create_hid_server(factory, reconnect_bt_addr=args.reconnect_bt_addr,
+                                                  ctl_psm=ctl_psm,
+                                                  itr_psm=itr_psm, capture_file=capture_file,
+                                                  device_id=args.device_id,
+                                                  interactive=True)
+
+    controller_state = protocol.get_controller_state()
+
+    # Create command line interface and add some extra commands
+    cli = ControllerCLI(controller_state)
+    _register_commands_with_controller_state(controller_state, cli)
+    cli.add_command('amiibo', ControllerCLI.deprecated('Command was removed - use "nfc" instead!'))
+    cli.add_command(debug.debug.__name__, debug.debug)
 
-    with utils.get_output(path=args.log, default=None) as capture_file:
-        # prepare the the emulated controller
-        factory = controller_protocol_factory(controller, spi_flash=spi_flash, reconnect = args.reconnect_bt_addr)
-        ctl_psm, itr_psm = 17, 19
-        transport, protocol = await create_hid_server(factory, reconnect_bt_addr=args.reconnect_bt_addr,
-                                                      ctl_psm=ctl_psm,
-                                                      itr_psm=itr_psm, capture_file=capture_file,
-                                                      device_id=args.device_id,
-                                                      interactive=True)
+    # set default nfc content supplied by argument
+    if args.nfc is not None:
+        await cli.commands['nfc'](args.nfc)
 
-        controller_state = protocol.get_controller_state()
+    return transport, cli
 
-        # Create command line interface and add some extra commands
-        cli = ControllerCLI(controller_state)
-        cli.add_command('amiibo', ControllerCLI.deprecated('Command was removed - use "nfc" instead!'))
-        cli.add_command(debug.debug.__name__, debug.debug)
 
-        # set default nfc content supplied by argument
-        if args.nfc is not None:
-            await cli.commands['nfc'](args.nfc)
+def _connect_pavlok(args):
+    """
+    Starts connecting to the Pavlok in the background, Bluetooth connection setup blocks for several seconds.
+    :returns: PavlokShocker queueing shocks behind the connection
+    """
+    from PyPav2.PyPav2 import Pavlok
+    from loops.pygame_batched import PavlokShocker
 
-        # access gamepad
-        pygame.init()
-        joysticks = []
-        for i in range(0, pygame.joystick.get_count()):
-            joysticks.append(pygame.joystick.Joystick(i))
-            joysticks[-1].init()
-            print ("Initialized gamepad")
+    return PavlokShocker(functools.partial(Pavlok, mac=args.pavlok_mac), args.shock_value)
 
-        # connect to pavlok
-        pavlok = Pavlok(mac=args.pavlok_mac)
-        #pavlok.shock(args.shock_value)
 
-        # start main run loop
-        try:
-            await run(cli, pavlok, args.shock_value)
-        finally:
-            logger.info('Stopping communication...')
-            await transport.close()
+async def _main_loop(cli, args, shocker=None):
+    if args.mode == 'cli':
+        await cli.run()
+        return
+
+    # pygame is only imported when needed
+    from loops.pygame_batched import run
+
+    # shocker is None unless in pavlok mode
+    await run(cli.controller_state, shocker)
+
+
+async def _main(args):
+    # connect to pavlok while the controller waits for the Switch
+    shocker = _connect_pavlok(args) if args.mode == 'pavlok' else None
+
+    try:
+        with utils.get_output(path=args.log, default=None) as capture_file:
+            transport, cli = await _setup_transport(args, capture_file)
+
+            # start main run loop
+            try:
+                await _main_loop(cli, args, shocker)
+            finally:
+                logger.info('Stopping communication...')
+                await transport.close()
+    finally:
+        if shocker is not None:
+            shocker.close()
 
 
 if __name__ == '__main__':
@@ -184,10 +187,16 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--reconnect_bt_addr', type=str, default=None,
                         help='The Switch console Bluetooth address (or "auto" for automatic detection), for reconnecting as an already paired controller.')
     parser.add_argument('--nfc', type=str, default=None, help="amiibo dump placed on the controller. Äquivalent to the nfc command.")
-    parser.add_argument('--pavlok_mac', type=str)
-    parser.add_argument('--shock_value', type=int, default=4)
+    parser.add_argument('--mode', choices=('cli', 'gamepad', 'pavlok'), default='pavlok',
+                        help='cli: interactive command line, gamepad: forward a gamepad, '
+                             'pavlok (default): gamepad with shocks')
+    parser.add_argument('--pavlok_mac', type=str, help='Pavlok Bluetooth address, only valid in pavlok mode')
+    parser.add_argument('--shock_value', type=int, default=4, help='shock intensity used in pavlok mode')
     args = parser.parse_args()
 
+    if args.mode != 'pavlok' and args.pavlok_mac is not None:
+        parser.error(f'--pavlok_mac is not used in {args.mode} mode')
+
     loop = asyncio.get_event_loop()
     loop.run_until_complete(
         _main(args)
@@ -6,7 +6,7 @@ setup(name='joycontrol',
       author='Robert Martin',
       author_email='martinro@informatik.hu-berlin.de',
       description='Emulate Nintendo Switch Controllers over Bluetooth',
-      packages=find_packages(),
+      packages=find_packages(exclude=('loops', 'loops.*')),
       package_data={'joycontrol': ['profile/sdp_record_hid.xml']},
       zip_safe=False,
       install_requires=[